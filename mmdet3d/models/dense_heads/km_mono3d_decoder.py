@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import warnings
+
 import torch
 import torch.nn as nn
 from .km_mono3d_utils import _gather_feat, _transpose_and_gather_feat
@@ -13,8 +15,7 @@ def _nms(heat, kernel=3):
 
     hmax = nn.functional.max_pool2d(
         heat, (kernel, kernel), stride=1, padding=pad)
-    keep = (hmax == heat).float()
-    return heat * keep
+    return heat.masked_fill(hmax != heat, 0)
 
 
 def _left_aggregate(heat):
@@ -85,29 +86,15 @@ def _v_aggregate(heat, aggr_weight=0.1):
            aggr_weight * _bottom_aggregate(heat) + heat
 
 
-'''
-# Slow for large number of categories
-def _topk(scores, K=40):
-    batch, cat, height, width = scores.size()
-    topk_scores, topk_inds = torch.topk(scores.view(batch, -1), K)
-
-    topk_clses = (topk_inds / (height * width)).int()
-
-    topk_inds = topk_inds % (height * width)
-    topk_ys   = (topk_inds / width).int().float()
-    topk_xs   = (topk_inds % width).int().float()
-    return topk_scores, topk_inds, topk_clses, topk_ys, topk_xs
-'''
-
-
 def _topk_channel(scores, K=40):
     batch, cat, height, width = scores.size()
 
     topk_scores, topk_inds = torch.topk(scores.view(batch, cat, -1), K)
 
     topk_inds = topk_inds % (height * width)
-    topk_ys = (topk_inds / width).int().float()
-    topk_xs = (topk_inds % width).int().float()
+    topk_ys = topk_inds // width
+    topk_xs = (topk_inds - topk_ys * width).float()
+    topk_ys = topk_ys.float()
 
     return topk_scores, topk_inds, topk_ys, topk_xs
 
@@ -115,20 +102,15 @@ def _topk_channel(scores, K=40):
 def _topk(scores, K=40):
     batch, cat, height, width = scores.size()
 
-    topk_scores, topk_inds = torch.topk(scores.view(batch, cat, -1), K)
-
-    topk_inds = topk_inds % (height * width)
-    topk_ys = (topk_inds / width).int().float()
-    topk_xs = (topk_inds % width).int().float()
+    topk_scores, topk_inds = torch.topk(scores.view(batch, -1), K)
 
-    topk_score, topk_ind = torch.topk(topk_scores.view(batch, -1), K)
-    topk_clses = (topk_ind / K).int()
-    topk_inds = _gather_feat(
-        topk_inds.view(batch, -1, 1), topk_ind).view(batch, K)
-    topk_ys = _gather_feat(topk_ys.view(batch, -1, 1), topk_ind).view(batch, K)
-    topk_xs = _gather_feat(topk_xs.view(batch, -1, 1), topk_ind).view(batch, K)
+    topk_clses = topk_inds // (height * width)
+    topk_inds = topk_inds - topk_clses * (height * width)
+    topk_ys = topk_inds // width
+    topk_xs = (topk_inds - topk_ys * width).float()
+    topk_ys = topk_ys.float()
 
-    return topk_score, topk_inds, topk_clses, topk_ys, topk_xs
+    return topk_scores, topk_inds, topk_clses.int(), topk_ys, topk_xs
 
 
 def agnex_ct_decode(
@@ -497,17 +479,50 @@ def ctdet_decode(heat, wh, reg=None, cat_spec_wh=False, K=100):
         wh = wh.view(batch, K, 2)
     clses = clses.view(batch, K, 1).float()
     scores = scores.view(batch, K, 1)
-    bboxes = torch.cat([xs - wh[..., 0:1] / 2,
-                        ys - wh[..., 1:2] / 2,
-                        xs + wh[..., 0:1] / 2,
-                        ys + wh[..., 1:2] / 2], dim=2)
+    xys = torch.cat([xs, ys], dim=2)
+    half_wh = wh * 0.5
+    bboxes = torch.cat([xys - half_wh, xys + half_wh], dim=2)
     detections = torch.cat([bboxes, scores, clses], dim=2)
 
     return detections
 
 
+def _match_kps(kps, hm_score, hm_xs, hm_ys, bboxes, thresh=0.1):
+    '''
+        kps: batchsize x joints x K x 2 regressed keypoints
+        hm_score, hm_xs, hm_ys: batchsize x joints x K heatmap keypoints
+        bboxes: batchsize x K x 4
+        Replaces each regressed keypoint by its nearest confident heatmap
+        keypoint when that one lies inside the box and close enough.
+    '''
+    batch, num_joints, K = hm_score.size()
+    mask = hm_score > thresh
+    hm_score = torch.where(mask, hm_score, hm_score.new_full((), -1))
+    hm_ys = torch.where(mask, hm_ys, hm_ys.new_full((), -10000))
+    hm_xs = torch.where(mask, hm_xs, hm_xs.new_full((), -10000))
+    hm_kps = torch.stack([hm_xs, hm_ys], dim=-1).float()  # b x J x K x 2
+    # exact pairwise distances, b x J x K x K
+    dist = ((kps.unsqueeze(3) - hm_kps.unsqueeze(2)) ** 2).sum(dim=4) ** 0.5
+    min_dist, min_ind = dist.min(dim=3)  # b x J x K
+    hm_score = hm_score.gather(2, min_ind).unsqueeze(-1)  # b x J x K x 1
+    min_dist = min_dist.unsqueeze(-1)
+    hm_kps = hm_kps.gather(
+        2, min_ind.unsqueeze(-1).expand(batch, num_joints, K, 2))
+    l = bboxes[:, :, 0].view(batch, 1, K, 1)
+    t = bboxes[:, :, 1].view(batch, 1, K, 1)
+    r = bboxes[:, :, 2].view(batch, 1, K, 1)
+    b = bboxes[:, :, 3].view(batch, 1, K, 1)
+    mask = (hm_kps[..., 0:1] < l) | (hm_kps[..., 0:1] > r) | \
+           (hm_kps[..., 1:2] < t) | (hm_kps[..., 1:2] > b) | \
+           (hm_score < thresh) | (min_dist > (torch.max(b - t, r - l) * 0.3))
+    mask = mask.expand(batch, num_joints, K, 2)
+    kps = torch.where(mask, kps, hm_kps)
+    return kps, hm_score, min_ind, hm_kps
+
+
 def multi_pose_decode(
-        heat, wh, kps, reg=None, hm_hp=None, hp_offset=None, K=100):
+        heat, wh, kps, reg=None, hm_hp=None, hp_offset=None, K=100,
+        hm_hp_nms=True):
     batch, cat, height, width = heat.size()
     num_joints = kps.shape[1] // 2
     # heat = torch.sigmoid(heat)
@@ -516,7 +531,8 @@ def multi_pose_decode(
     scores, inds, clses, ys, xs = _topk(heat, K=K)
 
     kps = _transpose_and_gather_feat(kps, inds)
-    kps = kps.view(batch, K, num_joints * 2)
+    # keypoints are offset and associated in fp32 for half head outputs
+    kps = kps.view(batch, K, num_joints * 2).float()
     kps[..., ::2] += xs.view(batch, K, 1).expand(batch, K, num_joints)
     kps[..., 1::2] += ys.view(batch, K, 1).expand(batch, K, num_joints)
     if reg is not None:
@@ -532,16 +548,16 @@ def multi_pose_decode(
     clses = clses.view(batch, K, 1).float()
     scores = scores.view(batch, K, 1)
 
-    bboxes = torch.cat([xs - wh[..., 0:1] / 2,
-                        ys - wh[..., 1:2] / 2,
-                        xs + wh[..., 0:1] / 2,
-                        ys + wh[..., 1:2] / 2], dim=2)
+    xys = torch.cat([xs, ys], dim=2)
+    half_wh = wh * 0.5
+    bboxes = torch.cat([xys - half_wh, xys + half_wh], dim=2)
     if hm_hp is not None:
-        hm_hp = _nms(hm_hp)
+        # hm_hp_nms=False skips this when hm_hp is already peak-suppressed
+        if hm_hp_nms:
+            hm_hp = _nms(hm_hp)
         thresh = 0.1
         kps = kps.view(batch, K, num_joints, 2).permute(
             0, 2, 1, 3).contiguous()  # b x J x K x 2
-        reg_kps = kps.unsqueeze(3).expand(batch, num_joints, K, K, 2)
         hm_score, hm_inds, hm_ys, hm_xs = _topk_channel(hm_hp, K=K)  # b x J x K
         if hp_offset is not None:
             hp_offset = _transpose_and_gather_feat(
@@ -553,29 +569,9 @@ def multi_pose_decode(
             hm_xs = hm_xs + 0.5
             hm_ys = hm_ys + 0.5
 
-        mask = (hm_score > thresh).float()
-        hm_score = (1 - mask) * -1 + mask * hm_score
-        hm_ys = (1 - mask) * (-10000) + mask * hm_ys
-        hm_xs = (1 - mask) * (-10000) + mask * hm_xs
-        hm_kps = torch.stack([hm_xs, hm_ys], dim=-1).unsqueeze(
-            2).expand(batch, num_joints, K, K, 2)
-        dist = (((reg_kps - hm_kps) ** 2).sum(dim=4) ** 0.5)
-        min_dist, min_ind = dist.min(dim=3)  # b x J x K
-        hm_score = hm_score.gather(2, min_ind).unsqueeze(-1)  # b x J x K x 1
-        min_dist = min_dist.unsqueeze(-1)
-        min_ind = min_ind.view(batch, num_joints, K, 1, 1).expand(
-            batch, num_joints, K, 1, 2)
-        hm_kps = hm_kps.gather(3, min_ind)
-        hm_kps = hm_kps.view(batch, num_joints, K, 2)
-        l = bboxes[:, :, 0].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        t = bboxes[:, :, 1].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        r = bboxes[:, :, 2].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        b = bboxes[:, :, 3].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        mask = (hm_kps[..., 0:1] < l) + (hm_kps[..., 0:1] > r) + \
-               (hm_kps[..., 1:2] < t) + (hm_kps[..., 1:2] > b) + \
-               (hm_score < thresh) + (min_dist > (torch.max(b - t, r - l) * 0.3))
-        mask = (mask > 0).float().expand(batch, num_joints, K, 2)
-        # kps = (1 - mask) * hm_kps + mask * kps
+        # keypoint matching is kept disabled for this decoder
+        _, hm_score, _, _ = _match_kps(
+            kps, hm_score, hm_xs, hm_ys, bboxes, thresh)
 
         kps = kps.permute(0, 2, 1, 3).contiguous().view(
             batch, K, num_joints * 2)
@@ -588,109 +584,128 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 
+class CompiledDecode(object):
+    '''
+        Explicit opt-in torch.compile wrapper for a decode function, e.g.
+        ``decode = CompiledDecode(car_pose_decode)``. Decoding falls back to
+        the eager function when torch.compile is missing, cannot be set up
+        on the running platform, or fails on a call (e.g. a backend error),
+        after which the compiled version is no longer tried.
+    '''
+
+    def __init__(self, func):
+        self.func = func
+        self.compiled = None
+        if not hasattr(torch, 'compile'):
+            return
+        try:
+            self.compiled = torch.compile(func, dynamic=False)
+        except RuntimeError as e:
+            warnings.warn(f'torch.compile is unavailable ({e}), '
+                          f'running {func.__name__} eagerly.')
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                warnings.warn(f'compiled {self.func.__name__} failed ({e}), '
+                              f'falling back to eager execution.')
+                self.compiled = None
+        return self.func(*args, **kwargs)
+
+
+def _inverse_3x3(mat):
+    '''
+        mat: N x 3 x 3, inverted in closed form via the adjugate
+    '''
+    a, b, c = mat[:, 0, 0], mat[:, 0, 1], mat[:, 0, 2]
+    d, e, f = mat[:, 1, 0], mat[:, 1, 1], mat[:, 1, 2]
+    g, h, i = mat[:, 2, 0], mat[:, 2, 1], mat[:, 2, 2]
+
+    co_a = e * i - f * h
+    co_b = f * g - d * i
+    co_c = d * h - e * g
+    det = a * co_a + b * co_b + c * co_c
+
+    adj = torch.stack([
+        co_a, c * h - b * i, b * f - c * e,
+        co_b, a * i - c * g, c * d - a * f,
+        co_c, b * g - a * h, a * e - b * d], dim=1).view(-1, 3, 3)
+    return adj / det.view(-1, 1, 1)
+
+
 def gen_position(kps, dim, rot, meta, const):
     b = kps.size(0)  # 1
     c = kps.size(1)  # 100
     opinv = meta['trans_output_inv']  # 1 2 3
     calib = meta['calib']  # 1 3 4
+    # keypoint projection and the 3x3 solve run in fp32 for half inputs,
+    # and the results stay in fp32 to keep sub-pixel / sub-metre precision
 
-    opinv = opinv.unsqueeze(1)  # 1 1 2 3
-    opinv = opinv.expand(b, c, -1, -1).contiguous().view(-1, 2, 3).float()  # 100 2 3
-    kps = kps.view(b, c, -1, 2).permute(0, 1, 3, 2)  # 1 100 2 9
-    hom = torch.ones(b, c, 1, 9).cuda()  # 1 100 1 9
-    kps = torch.cat((kps, hom), dim=2).view(-1, 3, 9)  # 100 3 9
+    opinv = opinv.unsqueeze(1).float()  # 1 1 2 3
+    kps = kps.view(b, c, -1, 2).permute(0, 1, 3, 2).float()  # 1 100 2 9
 
-    kps = torch.bmm(opinv, kps).view(b, c, 2, 9)  # 1 100 2 9     [[xxxxxxx...],[yyyyyy...]]
-    print(kps[:, :2, :, :])
+    # affine transform: rotation/scale part plus translation column
+    kps = torch.matmul(opinv[..., :2], kps) + opinv[..., 2:3]  # 1 100 2 9     [[xxxxxxx...],[yyyyyy...]]
     kps = kps.permute(0, 1, 3, 2).contiguous().view(b, c, -1)  # 1 100 18 [xyxyxyxyx....]
-    print(kps[:, :2, :])
-    si = torch.zeros_like(kps[:, :, 0:1]) + calib[:, 0:1, 0:1]  # 1 100 1
-    print('si', si[:, :2, :])
     alpha_idx = rot[:, :, 1] > rot[:, :, 5]  # 1 100
-    alpha_idx = alpha_idx.float()  # 1 100
-    alpha1 = torch.atan(rot[:, :, 2] / rot[:, :, 3]) + (-0.5 * np.pi)  # 1 100
-    alpha2 = torch.atan(rot[:, :, 6] / rot[:, :, 7]) + (0.5 * np.pi)  # 1 100
-    alpna_pre = alpha1 * alpha_idx + alpha2 * (1 - alpha_idx)  # 1 100
+    alpha1 = torch.atan2(rot[:, :, 2], rot[:, :, 3]) - 0.5 * np.pi  # 1 100
+    alpha2 = torch.atan2(rot[:, :, 6], rot[:, :, 7]) + 0.5 * np.pi  # 1 100
+    alpna_pre = torch.where(alpha_idx, alpha1, alpha2)  # 1 100
     alpna_pre = alpna_pre.unsqueeze(2)  # 1 100
     # alpna_pre=rot_gt
 
-    rot_y = alpna_pre + torch.atan2(kps[:, :, 16:17] - calib[:, 0:1, 2:3], si)  # 1 100 1
-    rot_y[rot_y > np.pi] = rot_y[rot_y > np.pi] - 2 * np.pi  # 1 100 1
-    print('rot_y', rot_y[:, :2, :])
-    rot_y[rot_y < - np.pi] = rot_y[rot_y < - np.pi] + 2 * np.pi  # 1 100 1
+    rot_y = alpna_pre + torch.atan2(kps[:, :, 16:17] - calib[:, 0:1, 2:3], calib[:, 0:1, 0:1])  # 1 100 1
+    rot_y = torch.remainder(rot_y + np.pi, 2 * np.pi) - np.pi  # 1 100 1
 
-    calib = calib.unsqueeze(1)  # 1 1 3 4
-    calib = calib.expand(b, c, -1, -1).contiguous()  # 1 100 3 4
     kpoint = kps[:, :, :16]  # 1 100 16
-    f = calib[:, :, 0, 0].unsqueeze(2)  # 1 100 1
-    f = f.expand_as(kpoint)  # 1 100 16
-    cx, cy = calib[:, :, 0, 2].unsqueeze(2), calib[:, :, 1, 2].unsqueeze(2)  # 1 100 1 , 1 100 1
-    cxy = torch.cat((cx, cy), dim=2)  # 1 100 2
-    cxy = cxy.repeat(1, 1, 8)  # 1 100 16
+    f = calib[:, 0:1, 0:1]  # 1 1 1
+    cxy = calib[:, 0:2, 2].unsqueeze(1)  # 1 1 2
+    cxy = cxy.repeat(1, 1, 8)  # 1 1 16
     kp_norm = (kpoint - cxy) / f  # 1 100 16
 
     l = dim[:, :, 2:3]  # 1 100 1
     h = dim[:, :, 0:1]  # 1 100 1
     w = dim[:, :, 1:2]  # 1 100 1
+    # rot_y is only b x c x 1, so a fused sincos would save nothing measurable
     cosori = torch.cos(rot_y)  # 1 100 1
     sinori = torch.sin(rot_y)  # 1 100 1
 
-    B = torch.zeros_like(kpoint)  ##1 100 16
-    C = torch.zeros_like(kpoint)  # 1 100 16
-
-    kp = kp_norm.unsqueeze(3)  # 1,100,16,1
-    const = const.expand(b, c, -1, -1)  # 1 100 16 2
-    A = torch.cat([const, kp], dim=3)  # 1 100 16 3
-
-    B[:, :, 0:1] = l * 0.5 * cosori + w * 0.5 * sinori
-    B[:, :, 1:2] = h * 0.5
-    B[:, :, 2:3] = l * 0.5 * cosori - w * 0.5 * sinori
-    B[:, :, 3:4] = h * 0.5
-    B[:, :, 4:5] = -l * 0.5 * cosori - w * 0.5 * sinori
-    B[:, :, 5:6] = h * 0.5
-    B[:, :, 6:7] = -l * 0.5 * cosori + w * 0.5 * sinori
-    B[:, :, 7:8] = h * 0.5
-    B[:, :, 8:9] = l * 0.5 * cosori + w * 0.5 * sinori
-    B[:, :, 9:10] = -h * 0.5
-    B[:, :, 10:11] = l * 0.5 * cosori - w * 0.5 * sinori
-    B[:, :, 11:12] = -h * 0.5
-    B[:, :, 12:13] = -l * 0.5 * cosori - w * 0.5 * sinori
-    B[:, :, 13:14] = -h * 0.5
-    B[:, :, 14:15] = -l * 0.5 * cosori + w * 0.5 * sinori
-    B[:, :, 15:16] = -h * 0.5
-
-    C[:, :, 0:1] = -l * 0.5 * sinori + w * 0.5 * cosori
-    C[:, :, 1:2] = -l * 0.5 * sinori + w * 0.5 * cosori
-    C[:, :, 2:3] = -l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 3:4] = -l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 4:5] = l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 5:6] = l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 6:7] = l * 0.5 * sinori + w * 0.5 * cosori
-    C[:, :, 7:8] = l * 0.5 * sinori + w * 0.5 * cosori
-    C[:, :, 8:9] = -l * 0.5 * sinori + w * 0.5 * cosori
-    C[:, :, 9:10] = -l * 0.5 * sinori + w * 0.5 * cosori
-    C[:, :, 10:11] = -l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 11:12] = -l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 12:13] = l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 13:14] = l * 0.5 * sinori - w * 0.5 * cosori
-    C[:, :, 14:15] = l * 0.5 * sinori + w * 0.5 * cosori
-    C[:, :, 15:16] = l * 0.5 * sinori + w * 0.5 * cosori
+    lc = l * 0.5 * cosori  # 1 100 1
+    ls = l * 0.5 * sinori  # 1 100 1
+    wc = w * 0.5 * cosori  # 1 100 1
+    ws = w * 0.5 * sinori  # 1 100 1
+    h2 = h * 0.5  # 1 100 1
 
-    B = B - kp_norm * C  # 1 100 16
+    B = torch.stack([lc + ws, h2, lc - ws, h2, -lc - ws, h2, -lc + ws, h2,
+                     lc + ws, -h2, lc - ws, -h2, -lc - ws, -h2, -lc + ws, -h2],
+                    dim=2).view(b, c, 16)  # 1 100 16
+    C = torch.stack([-ls + wc, -ls - wc, ls - wc, ls + wc],
+                    dim=2).repeat_interleave(2, dim=2)  # 1 100 4 1 -> 1 100 8 1
+    C = C.repeat(1, 1, 2, 1).view(b, c, 16)  # 1 100 16
 
-    # A=A*kps_mask1
+    B = B - kp_norm * C  # 1 100 16
 
-    AT = A.permute(0, 1, 3, 2)  # 1 100 3 16
-    AT = AT.view(b * c, 3, 16)  # 100 3 16
-    A = A.view(b * c, 16, 3)  # 100 16 3
-    B = B.view(b * c, 16, 1).float()  # 100 16 1
+    # A = [const, kp_norm] (1 100 16 3) is never materialized: its first two
+    # columns are the fixed keypoint layout and are used by broadcasting
+    a0 = const[..., 0].float()  # 1 100 16
+    a1 = const[..., 1].float()  # 1 100 16
+    a2 = kp_norm.float()  # 1 100 16
+    B = B.float()  # 1 100 16
     # mask = mask.unsqueeze(2)
 
-    pinv = torch.bmm(AT, A)  # 100 3 3
-    pinv = torch.inverse(pinv)  # 100 3 3
-
-    pinv = torch.bmm(pinv, AT)  # 100 3 16
-    pinv = torch.bmm(pinv, B)  # 100 3 1
+    # A^T A is symmetric, so only its six unique entries are reduced
+    g00, g11, g22 = (a0 * a0).sum(2), (a1 * a1).sum(2), (a2 * a2).sum(2)
+    g01, g02, g12 = (a0 * a1).sum(2), (a0 * a2).sum(2), (a1 * a2).sum(2)
+    AtA = torch.stack([g.expand(b, c) for g in (g00, g01, g02,
+                                                g01, g11, g12,
+                                                g02, g12, g22)],
+                      dim=2).view(-1, 3, 3)  # 100 3 3
+    AtB = torch.stack([(a0 * B).sum(2), (a1 * B).sum(2), (a2 * B).sum(2)],
+                      dim=2).view(-1, 3, 1)  # 100 3 1
+
+    pinv = torch.bmm(_inverse_3x3(AtA), AtB)  # 100 3 1
     pinv = pinv.view(b, c, 3, 1).squeeze(3)  # 1 100 3
 
     # pinv[:, :, 1] = pinv[:, :, 1] + dim[:, :, 0] / 2
@@ -698,7 +713,8 @@ def gen_position(kps, dim, rot, meta, const):
 
 
 def car_pose_decode(
-        heat, wh, kps, dim, rot, prob=None, reg=None, hm_hp=None, hp_offset=None, K=100, meta=None, const=None):
+        heat, wh, kps, dim, rot, prob=None, reg=None, hm_hp=None, hp_offset=None, K=100, meta=None, const=None,
+        hm_hp_nms=True):
     batch, cat, height, width = heat.size()
     num_joints = kps.shape[1] // 2
     # heat = torch.sigmoid(heat)
@@ -713,7 +729,8 @@ def car_pose_decode(
     scores, inds, clses, ys, xs = _topk(heat, K=K)
 
     kps = _transpose_and_gather_feat(kps, inds)
-    kps = kps.view(batch, K, num_joints * 2)
+    # keypoints are offset and associated in fp32 for half head outputs
+    kps = kps.view(batch, K, num_joints * 2).float()
     kps[..., ::2] += xs.view(batch, K, 1).expand(batch, K, num_joints)
     kps[..., 1::2] += ys.view(batch, K, 1).expand(batch, K, num_joints)
     if reg is not None:
@@ -729,12 +746,11 @@ def car_pose_decode(
     clses = clses.view(batch, K, 1).float()
     scores = scores.view(batch, K, 1)
 
-    bboxes = torch.cat([xs - wh[..., 0:1] / 2,
-                        ys - wh[..., 1:2] / 2,
-                        xs + wh[..., 0:1] / 2,
-                        ys + wh[..., 1:2] / 2], dim=2)
+    xys = torch.cat([xs, ys], dim=2)
+    half_wh = wh * 0.5
+    bboxes = torch.cat([xys - half_wh, xys + half_wh], dim=2)
     dim = _transpose_and_gather_feat(dim, inds)
-    dim = dim.view(batch, K, 3)
+    dim = dim.view(batch, K, 3).float()
     # dim[:, :, 0] = torch.exp(dim[:, :, 0]) * 1.63
     # dim[:, :, 1] = torch.exp(dim[:, :, 1]) * 1.53
     # dim[:, :, 2] = torch.exp(dim[:, :, 2]) * 3.88
@@ -743,11 +759,12 @@ def car_pose_decode(
     prob = _transpose_and_gather_feat(prob, inds)[:, :, 0]
     prob = prob.view(batch, K, 1)
     if hm_hp is not None:
-        hm_hp = _nms(hm_hp)
+        # hm_hp_nms=False skips this when hm_hp is already peak-suppressed
+        if hm_hp_nms:
+            hm_hp = _nms(hm_hp)
         thresh = 0.1
         kps = kps.view(batch, K, num_joints, 2).permute(
             0, 2, 1, 3).contiguous()  # b x J x K x 2
-        reg_kps = kps.unsqueeze(3).expand(batch, num_joints, K, K, 2)
         hm_score, hm_inds, hm_ys, hm_xs = _topk_channel(hm_hp, K=K)  # b x J x K
         if hp_offset is not None:
             hp_offset = _transpose_and_gather_feat(
@@ -758,35 +775,14 @@ def car_pose_decode(
         else:
             hm_xs = hm_xs + 0.5
             hm_ys = hm_ys + 0.5
-        mask = (hm_score > thresh).float()
-        hm_score = (1 - mask) * -1 + mask * hm_score
-        hm_ys = (1 - mask) * (-10000) + mask * hm_ys
-        hm_xs = (1 - mask) * (-10000) + mask * hm_xs
-        hm_kps = torch.stack([hm_xs, hm_ys], dim=-1).unsqueeze(
-            2).expand(batch, num_joints, K, K, 2)
-        dist = (((reg_kps - hm_kps) ** 2).sum(dim=4) ** 0.5)
-        min_dist, min_ind = dist.min(dim=3)  # b x J x K
-        hm_score = hm_score.gather(2, min_ind).unsqueeze(-1)  # b x J x K x 1
-        min_dist = min_dist.unsqueeze(-1)
-        min_ind = min_ind.view(batch, num_joints, K, 1, 1).expand(
-            batch, num_joints, K, 1, 2)
-        hm_kps = hm_kps.gather(3, min_ind)
-        hm_kps = hm_kps.view(batch, num_joints, K, 2)
-        l = bboxes[:, :, 0].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        t = bboxes[:, :, 1].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        r = bboxes[:, :, 2].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        b = bboxes[:, :, 3].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
-        mask = (hm_kps[..., 0:1] < l) + (hm_kps[..., 0:1] > r) + \
-               (hm_kps[..., 1:2] < t) + (hm_kps[..., 1:2] > b) + \
-               (hm_score < thresh) + (min_dist > (torch.max(b - t, r - l) * 0.3))
-        mask = (mask > 0).float().expand(batch, num_joints, K, 2)
-        kps = (1 - mask) * hm_kps + mask * kps
+        kps, hm_score, _, _ = _match_kps(
+            kps, hm_score, hm_xs, hm_ys, bboxes, thresh)
         kps = kps.permute(0, 2, 1, 3).contiguous().view(
             batch, K, num_joints * 2)
         hm_score = hm_score.permute(0, 2, 1, 3).squeeze(3).contiguous()
     position, rot_y, kps_inv = gen_position(kps, dim, rot, meta, const)
 
-    detections = torch.cat([bboxes, scores, kps_inv, dim, hm_score, rot_y, position, prob, clses], dim=2)
+    detections = torch.cat([bboxes, scores.float(), kps_inv, dim, hm_score.float(), rot_y, position, prob.float(), clses], dim=2)
 
     return detections
 
@@ -11,8 +11,8 @@ def _sigmoid(x):
 
 def _gather_feat(feat, ind, mask=None):
     dim  = feat.size(2)
-    ind  = ind.unsqueeze(2).expand(ind.size(0), ind.size(1), dim)
-    feat = feat.gather(1, ind)
+    batch_ind = torch.arange(feat.size(0), device=ind.device).unsqueeze(1)
+    feat = feat[batch_ind, ind]
     if mask is not None:
         mask = mask.unsqueeze(2).expand_as(feat)
         feat = feat[mask]
@@ -20,9 +20,12 @@ def _gather_feat(feat, ind, mask=None):
     return feat
 
 def _transpose_and_gather_feat(feat, ind):
-    feat = feat.permute(0, 2, 3, 1).contiguous()
-    feat = feat.view(feat.size(0), -1, feat.size(3))
-    feat = _gather_feat(feat, ind)
+    # gather the K picked locations before transposing so that only
+    # batch x K x C values are moved instead of the whole feature map
+    feat = feat.reshape(feat.size(0), feat.size(1), -1)
+    batch_ind = torch.arange(feat.size(0), device=ind.device).unsqueeze(1)
+    # the index dims come first, but the layout may follow the source
+    feat = feat[batch_ind, :, ind].contiguous()
     return feat
 
 def flip_tensor(x):
@@ -0,0 +1,284 @@
+import numpy as np
+import pytest
+import torch
+from torch.nn import functional as F
+
+from mmdet3d.models.dense_heads.km_mono3d_decoder import (CompiledDecode,
+                                                          _inverse_3x3,
+                                                          _match_kps, _nms,
+                                                          _topk, _topk_channel,
+                                                          car_pose_decode,
+                                                          gen_position)
+
+
+def _get_meta_and_const(batch, device):
+    trans_output_inv = torch.tensor([[[4., 0., 8.], [0., 4., 4.]]])
+    calib = torch.tensor([[[721.5, 0., 609.6, 44.9], [0., 721.5, 172.9, 0.2],
+                           [0., 0., 1., 0.003]]])
+    meta = dict(
+        trans_output_inv=trans_output_inv.repeat(batch, 1, 1).to(device),
+        calib=calib.repeat(batch, 1, 1).to(device))
+    # x rows constrain X and y rows constrain Y of the box centre
+    const = torch.tensor([[-1., 0.], [0., -1.]]).repeat(8, 1).view(
+        1, 1, 16, 2).to(device)
+    return meta, const
+
+
+def _gen_position_baseline(kps, dim, rot, meta, const):
+    """Reference position solver with an explicit pseudo-inverse."""
+    b, c = kps.size(0), kps.size(1)
+    opinv = meta['trans_output_inv'].unsqueeze(1)
+    opinv = opinv.expand(b, c, -1, -1).contiguous().view(-1, 2, 3)
+    kps = kps.view(b, c, -1, 2).permute(0, 1, 3, 2)
+    hom = torch.ones(b, c, 1, 9)
+    kps = torch.cat((kps, hom), dim=2).view(-1, 3, 9)
+    kps = torch.bmm(opinv, kps).view(b, c, 2, 9)
+    kps = kps.permute(0, 1, 3, 2).contiguous().view(b, c, -1)
+
+    calib = meta['calib']
+    si = torch.zeros_like(kps[:, :, 0:1]) + calib[:, 0:1, 0:1]
+    alpha_idx = (rot[:, :, 1] > rot[:, :, 5]).float()
+    alpha1 = torch.atan(rot[:, :, 2] / rot[:, :, 3]) + (-0.5 * np.pi)
+    alpha2 = torch.atan(rot[:, :, 6] / rot[:, :, 7]) + (0.5 * np.pi)
+    alpha_pre = alpha1 * alpha_idx + alpha2 * (1 - alpha_idx)
+    rot_y = alpha_pre.unsqueeze(2) + torch.atan2(
+        kps[:, :, 16:17] - calib[:, 0:1, 2:3], si)
+    rot_y[rot_y > np.pi] = rot_y[rot_y > np.pi] - 2 * np.pi
+    rot_y[rot_y < -np.pi] = rot_y[rot_y < -np.pi] + 2 * np.pi
+
+    calib = calib.unsqueeze(1).expand(b, c, -1, -1).contiguous()
+    kpoint = kps[:, :, :16]
+    f = calib[:, :, 0, 0].unsqueeze(2).expand_as(kpoint)
+    cxy = torch.cat((calib[:, :, 0, 2].unsqueeze(2),
+                     calib[:, :, 1, 2].unsqueeze(2)), dim=2).repeat(1, 1, 8)
+    kp_norm = (kpoint - cxy) / f
+
+    l, h, w = dim[:, :, 2:3], dim[:, :, 0:1], dim[:, :, 1:2]
+    cosori, sinori = torch.cos(rot_y), torch.sin(rot_y)
+    B = torch.zeros_like(kpoint)
+    C = torch.zeros_like(kpoint)
+    signs = [(1, 1), (1, -1), (-1, -1), (-1, 1)] * 2
+    for k, (sl, sw) in enumerate(signs):
+        B[:, :, 2 * k:2 * k + 1] = sl * l * 0.5 * cosori + \
+            sw * w * 0.5 * sinori
+        B[:, :, 2 * k + 1:2 * k + 2] = h * 0.5 if k < 4 else -h * 0.5
+        C[:, :, 2 * k:2 * k + 2] = -sl * l * 0.5 * sinori + \
+            sw * w * 0.5 * cosori
+    B = B - kp_norm * C
+
+    A = torch.cat([const.expand(b, c, -1, -1), kp_norm.unsqueeze(3)], dim=3)
+    AT = A.permute(0, 1, 3, 2).reshape(b * c, 3, 16)
+    A = A.view(b * c, 16, 3)
+    B = B.view(b * c, 16, 1)
+    pinv = torch.inverse(torch.bmm(AT, A))
+    pinv = torch.bmm(torch.bmm(pinv, AT), B).view(b, c, 3)
+    return pinv, rot_y, kps
+
+
+def _nms_baseline(heat, kernel=3):
+    hmax = F.max_pool2d(heat, kernel, stride=1, padding=(kernel - 1) // 2)
+    return heat * (hmax == heat).float()
+
+
+def test_nms():
+    torch.manual_seed(0)
+    heat = torch.rand(2, 3, 32, 48)
+    for kernel in (3, 5):
+        assert torch.equal(
+            _nms(heat, kernel), _nms_baseline(heat, kernel))
+
+    heat.requires_grad_()
+    assert _nms(heat).requires_grad
+
+    if torch.cuda.is_available():
+        heat = heat.detach().cuda().half()
+        peaks = _nms(heat)
+        assert peaks.dtype == torch.half
+        assert torch.equal(peaks, _nms_baseline(heat).half())
+
+
+def _topk_channel_baseline(scores, K=40):
+    """Reference per-channel top-k with float division of indices."""
+    batch, cat, height, width = scores.size()
+    topk_scores, topk_inds = torch.topk(scores.view(batch, cat, -1), K)
+    topk_inds = topk_inds % (height * width)
+    topk_ys = (topk_inds.float() / width).int().float()
+    topk_xs = (topk_inds % width).int().float()
+    return topk_scores, topk_inds, topk_ys, topk_xs
+
+
+def _topk_baseline(scores, K=40):
+    """Reference two-stage top-k: per channel first, then over channels."""
+    batch = scores.size(0)
+    topk_scores, topk_inds, topk_ys, topk_xs = _topk_channel_baseline(
+        scores, K)
+
+    def _gather(feat, ind):
+        return feat.view(batch, -1, 1).gather(1, ind.unsqueeze(2)).view(
+            batch, K)
+
+    topk_score, topk_ind = torch.topk(topk_scores.view(batch, -1), K)
+    topk_clses = (topk_ind.float() / K).int()
+    return (topk_score, _gather(topk_inds, topk_ind), topk_clses,
+            _gather(topk_ys, topk_ind), _gather(topk_xs, topk_ind))
+
+
+def test_topk():
+    torch.manual_seed(0)
+    batch, cat, height, width, K = 2, 3, 12, 20, 40
+    # distinct scores so both implementations agree on the ordering
+    scores = torch.randperm(batch * cat * height * width).float().view(
+        batch, cat, height, width)
+
+    outs = _topk_channel(scores, K)
+    for out, expected in zip(outs, _topk_channel_baseline(scores, K)):
+        assert out.dtype == expected.dtype
+        assert torch.equal(out, expected)
+
+    outs = _topk(scores, K)
+    assert outs[2].dtype == torch.int32
+    assert outs[2].unique().numel() > 1
+    for out, expected in zip(outs, _topk_baseline(scores, K)):
+        assert out.dtype == expected.dtype
+        assert torch.equal(out, expected)
+
+
+def _match_kps_baseline(kps, hm_score, hm_xs, hm_ys, bboxes, thresh=0.1):
+    """Reference keypoint matching with explicit K x K expands."""
+    batch, num_joints, K = hm_score.size()
+    reg_kps = kps.unsqueeze(3).expand(batch, num_joints, K, K, 2)
+    mask = (hm_score > thresh).float()
+    hm_score = (1 - mask) * -1 + mask * hm_score
+    hm_ys = (1 - mask) * (-10000) + mask * hm_ys
+    hm_xs = (1 - mask) * (-10000) + mask * hm_xs
+    hm_kps = torch.stack([hm_xs, hm_ys], dim=-1).unsqueeze(2).expand(
+        batch, num_joints, K, K, 2)
+    dist = (((reg_kps - hm_kps)**2).sum(dim=4)**0.5)
+    min_dist, min_ind = dist.min(dim=3)
+    hm_score = hm_score.gather(2, min_ind).unsqueeze(-1)
+    min_dist = min_dist.unsqueeze(-1)
+    gather_ind = min_ind.view(batch, num_joints, K, 1, 1).expand(
+        batch, num_joints, K, 1, 2)
+    hm_kps = hm_kps.gather(3, gather_ind).view(batch, num_joints, K, 2)
+    l = bboxes[:, :, 0].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
+    t = bboxes[:, :, 1].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
+    r = bboxes[:, :, 2].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
+    b = bboxes[:, :, 3].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
+    mask = (hm_kps[..., 0:1] < l) + (hm_kps[..., 0:1] > r) + \
+        (hm_kps[..., 1:2] < t) + (hm_kps[..., 1:2] > b) + \
+        (hm_score < thresh) + (min_dist > (torch.max(b - t, r - l) * 0.3))
+    mask = (mask > 0).float().expand(batch, num_joints, K, 2)
+    kps = (1 - mask) * hm_kps + mask * kps
+    return kps, hm_score, min_ind, hm_kps
+
+
+def test_match_kps():
+    torch.manual_seed(0)
+    batch, num_joints, K = 2, 3, 8
+    kps = torch.rand(batch, num_joints, K, 2) * 20
+    # heatmap keypoints close to shuffled regressed keypoints
+    hm_kps = kps[:, :, torch.randperm(K)] + torch.randn(
+        batch, num_joints, K, 2) * 0.5
+    hm_xs, hm_ys = hm_kps[..., 0], hm_kps[..., 1]
+    hm_score = torch.rand(batch, num_joints, K) * 0.9 + 0.1
+    # below-threshold candidates turn into -10000 sentinels
+    hm_score[:, :, ::3] = 0.05
+    hm_score[0, 0] = 0.05
+    xy1 = torch.rand(batch, K, 2) * 4
+    bboxes = torch.cat([xy1, xy1 + 16], dim=2)
+
+    matched_kps, matched_score, min_ind, matched_hm_kps = _match_kps(
+        kps, hm_score, hm_xs, hm_ys, bboxes)
+    expected = _match_kps_baseline(kps, hm_score, hm_xs, hm_ys, bboxes)
+
+    assert torch.equal(min_ind, expected[2])
+    assert torch.allclose(matched_hm_kps, expected[3])
+    assert torch.allclose(matched_score, expected[1])
+    assert torch.allclose(matched_kps, expected[0])
+    # both the replaced and the kept branches are exercised
+    replaced = (matched_kps != kps).any(dim=-1)
+    assert replaced.any() and not replaced.all()
+    # a joint without any peak above threshold only sees sentinels
+    assert (matched_hm_kps[0, 0] == -10000).all()
+    assert torch.equal(matched_kps[0, 0], kps[0, 0])
+
+
+def test_inverse_3x3():
+    torch.manual_seed(0)
+    mat = torch.rand(10, 3, 3) + 3 * torch.eye(3)
+    eye = torch.eye(3).expand(10, 3, 3)
+    assert torch.allclose(torch.bmm(_inverse_3x3(mat), mat), eye, atol=1e-5)
+
+
+def test_gen_position():
+    torch.manual_seed(0)
+    batch, boxes = 2, 5
+    meta, const = _get_meta_and_const(batch, 'cpu')
+    kps = torch.rand(batch, boxes, 18) * torch.tensor([312., 96.]).repeat(9)
+    dim = torch.rand(batch, boxes, 3) * 3 + 1
+    # positive bin cosines keep the atan form of the reference equivalent
+    rot = torch.randn(batch, boxes, 8)
+    rot[:, :, 3] = rot[:, :, 3].abs() + 0.1
+    rot[:, :, 7] = rot[:, :, 7].abs() + 0.1
+
+    position, rot_y, kps_inv = gen_position(kps, dim, rot, meta, const)
+    expected_position, expected_rot_y, expected_kps_inv = \
+        _gen_position_baseline(kps, dim, rot, meta, const)
+
+    assert position.shape == (batch, boxes, 3)
+    assert rot_y.shape == (batch, boxes, 1)
+    assert kps_inv.shape == (batch, boxes, 18)
+    assert torch.allclose(kps_inv, expected_kps_inv, atol=1e-3)
+    assert torch.allclose(rot_y, expected_rot_y, atol=1e-5)
+    assert torch.allclose(
+        position, expected_position, rtol=1e-3, atol=1e-3)
+
+
+def test_car_pose_decode_fp16():
+    if not torch.cuda.is_available():
+        pytest.skip('test requires GPU and torch+cuda')
+    torch.manual_seed(0)
+    batch, height, width, K = 2, 32, 48, 100
+    num_joints = 9
+
+    def _rand(channels):
+        return torch.rand(batch, channels, height, width).cuda().half()
+
+    meta, const = _get_meta_and_const(batch, 'cuda')
+    dim = _rand(3) * 2 + 1
+    detections = car_pose_decode(
+        _rand(3),
+        _rand(2) * 10,
+        (_rand(num_joints * 2) - 0.5) * 10,
+        dim,
+        _rand(8),
+        prob=_rand(1),
+        reg=_rand(2),
+        hm_hp=_rand(num_joints),
+        hp_offset=_rand(2),
+        K=K,
+        meta=meta,
+        const=const)
+
+    # bboxes, score, kps, dim, hm_score, rot_y, position, prob, cls
+    assert detections.shape == (batch, K, 4 + 1 + 18 + 3 + 9 + 1 + 3 + 1 + 1)
+    assert detections.dtype == torch.float32
+    assert torch.isfinite(detections).all()
+
+
+def test_compiled_decode_fallback():
+
+    def decode(x):
+        return x + 1
+
+    def broken_decode(x):
+        raise RuntimeError('backend failure')
+
+    x = torch.rand(3)
+    compiled_decode = CompiledDecode(decode)
+    compiled_decode.compiled = broken_decode
+    with pytest.warns(UserWarning):
+        assert torch.equal(compiled_decode(x), x + 1)
+    # the failing compiled version is dropped after the first failure
+    assert compiled_decode.compiled is None
+    assert torch.equal(compiled_decode(x), x + 1)
@@ -0,0 +1,38 @@
+import torch
+
+from mmdet3d.models.dense_heads.km_mono3d_utils import (
+    _gather_feat, _transpose_and_gather_feat)
+
+
+def test_transpose_and_gather_feat():
+    torch.manual_seed(0)
+    batch, channels, height, width, K = 2, 5, 6, 7, 10
+    feat = torch.rand(batch, channels, height, width)
+    ind = torch.randint(0, height * width, (batch, K))
+
+    gathered = _transpose_and_gather_feat(feat, ind)
+    expected = feat.permute(0, 2, 3, 1).reshape(batch, -1, channels).gather(
+        1,
+        ind.unsqueeze(2).expand(batch, K, channels))
+
+    assert gathered.shape == (batch, K, channels)
+    assert gathered.is_contiguous()
+    assert torch.equal(gathered, expected)
+
+
+def test_gather_feat():
+    torch.manual_seed(0)
+    batch, num, dim, K = 2, 20, 3, 8
+    feat = torch.rand(batch, num, dim)
+    ind = torch.randint(0, num, (batch, K))
+    expected = feat.gather(1, ind.unsqueeze(2).expand(batch, K, dim))
+
+    gathered = _gather_feat(feat, ind)
+    assert gathered.shape == (batch, K, dim)
+    assert torch.equal(gathered, expected)
+
+    mask = torch.rand(batch, K) > 0.5
+    mask[0, 0] = True
+    gathered = _gather_feat(feat, ind, mask)
+    assert gathered.shape == (int(mask.sum()), dim)
+    assert torch.equal(gathered, expected[mask])